@@ -1,12 +1,25 @@
+import argparse
 import os.path
 import re
-
+import sqlite3
+import sys
+from collections.abc import Callable
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+import httplib2
+from google.auth.transport.requests import AuthorizedSession
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.discovery import Resource
 from googleapiclient.errors import HttpError
+from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError as RequestsHTTPError
+from urllib3.util.retry import Retry
 
 
 # If modifying these scopes, delete the file token.json.
@@ -16,45 +29,432 @@ SCOPES = [
     "https://www.googleapis.com/auth/gmail.readonly",
 ]
 
+# Email address within angle brackets, e.g. "Name <name@example.com>"
+EMAIL_RE = re.compile(r"<([^>]+)>")
+
+# Bare email address, as written by this script in filter criteria
+ADDRESS_RE = re.compile(r"[^\s()<>{}|\"]+@[^\s()<>{}|\"]+")
+
+# Maximum number of messages Gmail returns from a single list request
+PAGE_SIZE = 500
+
+# Maximum number of calls Gmail accepts in a single batch request
+# https://developers.google.com/gmail/api/guides/batch
+BATCH_SIZE = 100
+
+# Number of concurrent requests used when batch requests are unavailable
+MAX_WORKERS = 10
+
+# Number of times a concurrent call is retried, with an exponential backoff,
+# when Gmail rate limits it or fails temporarily
+MAX_RETRIES = 5
+
+# https://developers.google.com/gmail/api/reference/rest
+GMAIL_API_URL = "https://gmail.googleapis.com/gmail/v1"
+
+# Maximum length of the sender criteria of a single filter, longer criteria
+# are split into several filters
+FILTER_CRITERIA_MAX_LENGTH = 1500
+
+# Maximum length of the search query excluding already-filtered senders,
+# the remaining senders are excluded on the client side
+QUERY_MAX_LENGTH = 1500
+
+# Local cache of message senders, so reruns only fetch new messages
+CACHE_FILE = "tidyup_cache.sqlite"
+
+
+def open_cache(path: str) -> sqlite3.Connection:
+    """
+    Opens the local cache mapping message IDs to their sender, creating it if needed.
+
+    Args:
+        path: The path of the SQLite database file.
+
+    Returns:
+        An open connection to the cache.
+    """
+    cache = sqlite3.connect(path)
+    cache.execute("PRAGMA journal_mode=WAL")
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS msg_from (id TEXT PRIMARY KEY, sender TEXT)"
+    )
+    return cache
+
+
+def get_cached_senders(
+    cache: sqlite3.Connection, messages_ids: list[str]
+) -> dict[str, str | None]:
+    """
+    Looks up the senders of already seen messages in the local cache.
+
+    Args:
+        cache: An open connection to the cache.
+        messages_ids: A list of message IDs to look up.
+
+    Returns:
+        A dictionary mapping the message IDs found in the cache to their sender.
+    """
+    if not messages_ids:
+        return {}
+
+    placeholders = ", ".join("?" * len(messages_ids))
+    rows = cache.execute(
+        f"SELECT id, sender FROM msg_from WHERE id IN ({placeholders})", messages_ids
+    )
+    return dict(rows)
+
+
+def batch_get_senders(
+    service: Resource, messages_ids: list[str]
+) -> tuple[dict[str, str | None], list[str]]:
+    """
+    This function retrieves the sender of every message using Gmail batch requests.
+
+    Args:
+        service: An authorized Gmail API service object.
+        messages_ids: A list of message IDs.
+
+    Returns:
+        A dictionary mapping each fetched message ID to its sender, or None if it has
+        no sender, and a list of the message IDs whose call failed.
+    """
+    senders = {}
+    failed_ids = []
+
+    def collect_sender(request_id, response, exception):
+        # Keep going, so one failed call doesn't discard the rest of the batch
+        if exception is not None:
+            failed_ids.append(request_id)
+            return
+        # Only the From header is requested, so it is the single header returned
+        headers = response.get("payload", {}).get("headers", [])
+        senders[request_id] = headers[0]["value"] if headers else None
+
+    for start in range(0, len(messages_ids), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=collect_sender)
+        batch_ids = messages_ids[start : start + BATCH_SIZE]
+        for message_id in batch_ids:
+            batch.add(
+                service.users()
+                .messages()
+                .get(
+                    userId="me",
+                    id=message_id,
+                    format="metadata",
+                    metadataHeaders=["From"],
+                    fields="payload/headers",
+                ),
+                request_id=message_id,
+            )
+        try:
+            batch.execute()
+        except HttpError:
+            # The whole batch request failed, none of its calls were answered
+            failed_ids.extend(
+                message_id for message_id in batch_ids if message_id not in senders
+            )
+
+    return senders, failed_ids
+
+
+def create_session(creds: Credentials) -> AuthorizedSession:
+    """
+    Creates an authorized session retrying rate-limited calls with a backoff.
+
+    Args:
+        creds: The credentials used to authorize the requests.
+
+    Returns:
+        An authorized session retrying calls answered with 429, 500 or 503.
+    """
+    retries = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=1,
+        status_forcelist=(429, 500, 503),
+        # Return the last response, so raise_for_status reports the error
+        raise_on_status=False,
+    )
+    session = AuthorizedSession(creds)
+    session.mount("https://", HTTPAdapter(max_retries=retries))
+    return session
+
+
+def threaded_get_senders(
+    session: AuthorizedSession, messages_ids: list[str]
+) -> dict[str, str | None]:
+    """
+    This function retrieves the sender of every message using concurrent requests.
+
+    Args:
+        session: An authorized session shared by all workers.
+        messages_ids: A list of message IDs.
+
+    Returns:
+        A dictionary mapping each message ID to its sender, or None if it has no sender.
+    """
 
-def get_unique_senders(service: Resource, messages_list: list) -> set[str]:
+    def fetch_sender(message_id):
+        # The session can be shared between threads, unlike httplib2.Http
+        response = session.get(
+            f"{GMAIL_API_URL}/users/me/messages/{message_id}",
+            params={
+                "format": "metadata",
+                "metadataHeaders": "From",
+                "fields": "payload/headers",
+            },
+        )
+        # The message was deleted since it was listed
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        headers = response.json().get("payload", {}).get("headers", [])
+        return headers[0]["value"] if headers else None
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return dict(zip(messages_ids, executor.map(fetch_sender, messages_ids)))
+
+
+def get_unique_senders(
+    service: Resource,
+    messages_list: list,
+    session: AuthorizedSession,
+    cache: sqlite3.Connection,
+    seen_ids: set[str],
+    unique_senders: set[str],
+) -> set[str]:
     """
     This function finds all unique sender email addresses from a list of message IDs.
 
     Args:
         service: An authorized Gmail API service object.
         messages_list: A list of dictionaries containing message IDs (e.g., from a Gmail API response).
+        session: An authorized session used when falling back to concurrent requests.
+        cache: An open connection to the local cache of already seen messages.
+        seen_ids: IDs of the messages already processed during this run, updated in place.
+        unique_senders: Senders found so far during this run, updated in place.
+
+    Returns:
+        The set of unique senders, including those found in the messages.
+    """
+    # Messages can move between pages while paging, skip the ones already processed
+    messages_ids = [
+        message_id
+        for message_id in dict.fromkeys(mess["id"] for mess in messages_list)
+        if message_id not in seen_ids
+    ]
+    seen_ids.update(messages_ids)
+    senders = get_cached_senders(cache, messages_ids)
+    missing_ids = [
+        message_id for message_id in messages_ids if message_id not in senders
+    ]
+
+    if missing_ids:
+        fetched_senders, failed_ids = batch_get_senders(service, missing_ids)
+        if failed_ids:
+            # Calls can fail inside a batch (e.g. rate limits on inner calls),
+            # retry only those, sending them concurrently
+            fetched_senders.update(threaded_get_senders(session, failed_ids))
+
+        # Store the whole page in a single transaction
+        with cache:
+            cache.executemany(
+                "INSERT OR IGNORE INTO msg_from (id, sender) VALUES (?, ?)",
+                fetched_senders.items(),
+            )
+        senders.update(fetched_senders)
+
+    unique_senders.update(sender for sender in senders.values() if sender)
+
+    return unique_senders
+
+
+def get_filtered_senders_query(
+    filtered_senders: set[str], max_len: int = QUERY_MAX_LENGTH
+) -> str:
+    """
+    Builds a Gmail search query excluding as many already-filtered senders as fit.
+
+    Args:
+        filtered_senders: A set of senders matched by user-defined filters.
+        max_len: The maximum length of the query.
+
+    Returns:
+        A query string with a "-from:" operator for every sender that fits.
+    """
+    # Criteria other than bare addresses can only be excluded by the query, so
+    # they go first; addresses left out are checked on the client side instead
+    terms = []
+    length = 0
+    for sender in sorted(
+        filtered_senders,
+        key=lambda sender: (bool(ADDRESS_RE.fullmatch(sender)), sender),
+    ):
+        term = f"-from:({sender})"
+        added = len(term) + 1 if terms else len(term)
+        if length + added > max_len:
+            continue
+        terms.append(term)
+        length += added
+
+    return " ".join(terms)
+
+
+def list_messages(
+    service: Resource,
+    page_token: str | None,
+    query: str,
+    http: httplib2.Http | None = None,
+) -> dict:
+    """
+    Retrieves a single page of messages from the user's mailbox.
+
+    Args:
+        service: An authorized Gmail API service object.
+        page_token: The token of the page to retrieve, or None for the first page.
+        query: A Gmail search query restricting the returned messages.
+        http: An optional connection to send the request on instead of the service's own.
+
+    Returns:
+        The list response containing the messages and the next page token.
+    """
+    return (
+        service.users()
+        .messages()
+        .list(
+            userId="me",
+            maxResults=PAGE_SIZE,
+            pageToken=page_token,
+            q=query,
+            fields="messages/id,nextPageToken",
+        )
+        .execute(http=http)
+    )
+
+
+def read_marked_senders(path: str) -> set[str]:
+    """
+    Reads the senders to mark from a file, one per line.
+
+    Args:
+        path: The path of the file.
+
+    Returns:
+        A set of the senders or email addresses listed in the file.
+    """
+    try:
+        with open(path) as file:
+            return {line.strip() for line in file if line.strip()}
+    except OSError as error:
+        raise argparse.ArgumentTypeError(f"can't read '{path}': {error.strerror}")
+
+
+def compile_mark_regex(value: str) -> re.Pattern:
+    """
+    Compiles the regular expression selecting the senders to mark.
+
+    Args:
+        value: The regular expression given on the command line.
 
     Returns:
-        A set containing all unique sender email addresses found in the messages.
+        The compiled regular expression.
+    """
+    try:
+        return re.compile(value)
+    except re.error as error:
+        raise argparse.ArgumentTypeError(
+            f"invalid regular expression '{value}': {error}"
+        )
+
+
+def parse_args() -> argparse.Namespace:
     """
-    unique_senders = set()
+    Parses the command line options selecting senders without prompting.
 
-    for mess in messages_list:
-        message_data = (
-            service.users()
-            .messages()
-            .get(userId="me", id=mess["id"], format="full")
-            .execute()
+    Returns:
+        The parsed command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Create a Gmail filter moving messages from marked senders to trash."
+    )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--mark-all", action="store_true", help="mark every sender without prompting"
+    )
+    group.add_argument(
+        "--mark-none", action="store_true", help="mark no sender without prompting"
+    )
+    group.add_argument(
+        "--mark-from-file",
+        metavar="PATH",
+        type=read_marked_senders,
+        help="mark senders or email addresses listed in a file, one per line",
+    )
+    group.add_argument(
+        "--mark-regex",
+        metavar="RE",
+        type=compile_mark_regex,
+        help="mark senders matching a regular expression",
+    )
+    args = parser.parse_args()
+
+    # Fail before any API work instead of hitting the end of piped input
+    # while prompting
+    interactive = not (
+        args.mark_all
+        or args.mark_none
+        or args.mark_from_file is not None
+        or args.mark_regex is not None
+    )
+    if interactive and not sys.stdin.isatty():
+        parser.error(
+            "input is not interactive, use --mark-all, --mark-none, "
+            "--mark-from-file or --mark-regex"
         )
-        for header in message_data["payload"]["headers"]:
-            if header["name"] == "From":
-                if header["value"] not in unique_senders:
-                    unique_senders.add(header["value"])
 
-    return unique_senders
+    return args
+
+
+def get_mark_predicate(args: argparse.Namespace) -> Callable[[str], bool] | None:
+    """
+    Builds the predicate selecting senders from the command line options.
+
+    Args:
+        args: The parsed command line arguments.
+
+    Returns:
+        A function telling whether a sender is marked, or None to prompt the user.
+    """
+    if args.mark_all:
+        return lambda sender: True
+    if args.mark_none:
+        return lambda sender: False
+    if args.mark_regex is not None:
+        return lambda sender: bool(args.mark_regex.search(sender))
+    if args.mark_from_file is not None:
+        # Entries can be either full senders or bare email addresses
+        return lambda sender: sender in args.mark_from_file or any(
+            email in args.mark_from_file for email in extract_emails({sender})
+        )
+    return None
 
 
-def mark_senders(senders_list: list[str]) -> list[str]:
+def mark_senders(
+    senders_list: list[str], predicate: Callable[[str], bool] | None = None
+) -> list[str]:
     """
     This function interactively marks senders for further processing.
 
     Args:
         senders_list: A list of sender names and addresses.
+        predicate: An optional function marking senders without prompting the user.
 
     Returns:
         A list containing only the marked senders.
     """
+    if predicate is not None:
+        return [item for item in senders_list if predicate(item)]
+
     marked_senders = []
     for item in senders_list:
         # The function now ensures that only valid input ("y" or "n") is accepted before proceeding.
@@ -72,55 +472,108 @@ def mark_senders(senders_list: list[str]) -> list[str]:
 
 def extract_emails(senders: set[str]) -> list[str]:
     """
-    Extracts email addresses from a set of strings and joins them with "OR".
+    Extracts email addresses from a set of strings.
 
     Args:
-        senders: A set of strings containing sender name and addresse.
+        senders: A set of strings containing sender name and addresses.
 
     Returns:
-        A string containing the extracted email addresses joined with "OR".
+        A list containing the extracted email addresses.
     """
-    emails = []
-    for text in senders:
-        email_match = re.search(r"<(.*?)>", text)  # Extract email within angle brackets
-        if email_match:
-            email = email_match.group(1)
-            emails.append(email)
-    return emails
+    return [
+        email_match.group(1)
+        for email_match in map(EMAIL_RE.search, senders)
+        if email_match
+    ]
 
 
-def identify_unfiltered_emails(service: Resource, email_list: list[str]) -> list[str]:
+def get_filtered_senders(service: Resource) -> set[str]:
     """
-    Identifies emails from a provided list that are not present in any user-defined filters.
+    Collects the senders already present in user-defined filters.
 
     Args:
         service: An authorized Gmail API service object.
-        email_list: A list of email strings.
 
     Returns:
-        A list of email addresses that are not found in any filters.
+        A set of sender addresses matched by at least one filter, and of the whole
+        criteria of filters that are not a plain list of addresses.
+    """
+    filters_list = (
+        service.users()
+        .settings()
+        .filters()
+        .list(userId="me", fields="filter/criteria/from")
+        .execute()
+    )
+
+    filtered_senders = set()
+    for filter in filters_list.get("filter", []):
+        criteria = filter.get("criteria", {}).get("from")
+        if not criteria:
+            continue
+        # Only split criteria in the "a OR b" form written by this script, any
+        # other criteria (names, groups, "|" or "{a b}") is kept as a whole
+        senders = [sender.strip() for sender in criteria.split(" OR ")]
+        if all(ADDRESS_RE.fullmatch(sender) for sender in senders):
+            filtered_senders.update(senders)
+        else:
+            filtered_senders.add(criteria.strip())
+
+    return filtered_senders
+
+
+def chunk_or(
+    emails: list[str], max_len: int = FILTER_CRITERIA_MAX_LENGTH
+) -> Iterator[str]:
     """
-    filters_list = service.users().settings().filters().list(userId="me").execute()
+    Joins email addresses with "OR" into chunks short enough for a single filter.
 
-    unfiltered_emails = []
+    Args:
+        emails: A list of email addresses.
+        max_len: The maximum length of a single chunk.
 
-    if "filter" in filters_list:
-        for email in email_list:
-            for filter in filters_list["filter"]:
-                # Check if email matches the filter criteria
-                if email in filter["criteria"]["from"]:
-                    break
-            else:
-                unfiltered_emails.append(email)
-    else:
-        # Add all emails to unfiltered list if no filters exist
-        print("No filters found, all emails considered unfiltered.")
-        unfiltered_emails.extend(email_list)
+    Yields:
+        Strings containing the email addresses of a chunk joined with "OR".
+    """
+    chunk = []
+    length = 0
+    for email in emails:
+        # Every address after the first one is preceded by " OR "
+        added = len(email) + len(" OR ") if chunk else len(email)
+        if chunk and length + added > max_len:
+            yield " OR ".join(chunk)
+            chunk = []
+            length = 0
+            added = len(email)
+        chunk.append(email)
+        length += added
+
+    if chunk:
+        yield " OR ".join(chunk)
+
+
+def save_credentials(creds: Credentials, path: str = "token.json") -> None:
+    """
+    Saves the credentials for the next run without leaving a truncated token file.
 
-    return " OR ".join(unfiltered_emails)
+    Args:
+        creds: The credentials to save.
+        path: The path of the token file.
+    """
+    # Write a temporary file first, so an interrupted write keeps the old token
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "w") as token:
+            token.write(creds.to_json())
+        os.replace(tmp_path, path)
+    finally:
+        # Only left behind if the write or the rename failed
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 def main():
+    args = parse_args()
     creds = None
     # The file token.json stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
@@ -135,63 +588,103 @@ def main():
             flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
             creds = flow.run_local_server(port=0)
         # Save the credentials for the next run
-        with open("token.json", "w") as token:
-            token.write(creds.to_json())
+        save_credentials(creds)
 
     try:
-        # Create gmail api client
-        service = build("gmail", "v1", credentials=creds)
+        # Create gmail api client from the discovery document bundled with the library
+        service = build("gmail", "v1", credentials=creds, static_discovery=True)
         page_token = None
-
-        # Get emails
-        messages = (
-            service.users()
-            .messages()
-            .list(userId="me", maxResults=250, pageToken=page_token)
-            .execute()
-            .get("messages")
-        )
-
-        while True:
-            senders = mark_senders(get_unique_senders(service, messages))
-            emails = extract_emails(senders)
-
-            unfiltered_emails = identify_unfiltered_emails(service, emails)
-
-            page_token = messages[-1].get("nextPageToken", None)
-
-            # Check for the presence of a next page token
-            # lastest message on a page contains information does next page exists
-            # if page_token does not exist, sets token to 'None'
-            if not page_token:
-                break
-
-        # Change filter criteria
-        # https://developers.google.com/gmail/api/reference/rest/v1/users.settings.filters#Filter
-        filter_content = {
-            "criteria": {"from": f"{unfiltered_emails}"},
-            "action": {
-                "addLabelIds": ["TRASH"],
-                "removeLabelIds": ["INBOX"],
-            },
-        }
-
-        result = (
-            service.users()
-            .settings()
-            .filters()
-            .create(userId="me", body=filter_content)
-            .execute()
+        seen_ids = set()
+        unique_senders = set()
+
+        # Senders covered by existing filters are excluded on the server side
+        filtered_senders = get_filtered_senders(service)
+        query = get_filtered_senders_query(filtered_senders)
+
+        # Download the senders of every page first, without waiting for user input
+        with (
+            closing(open_cache(CACHE_FILE)) as cache,
+            # Shared by the concurrent fallback, reusing its connections across pages
+            closing(create_session(creds)) as session,
+            # Separate connection for prefetching, httplib2.Http is not thread-safe
+            closing(AuthorizedHttp(creds, http=httplib2.Http())) as prefetch_http,
+            ThreadPoolExecutor(max_workers=1) as executor,
+        ):
+            # Get emails
+            response = list_messages(service, page_token, query)
+
+            while True:
+                messages = response.get("messages", [])
+
+                # The next page token is returned alongside the messages,
+                # if it does not exist this is the last page
+                page_token = response.get("nextPageToken")
+
+                # Fetch the next page while the senders of this one are retrieved
+                next_page = None
+                if page_token:
+                    next_page = executor.submit(
+                        list_messages, service, page_token, query, prefetch_http
+                    )
+
+                get_unique_senders(
+                    service, messages, session, cache, seen_ids, unique_senders
+                )
+
+                if next_page is None:
+                    break
+                response = next_page.result()
+
+        # Filtered addresses that did not fit in the query are excluded here
+        senders_list = [
+            sender
+            for sender in sorted(unique_senders)
+            if filtered_senders.isdisjoint(extract_emails({sender}))
+        ]
+
+        # Then let the user mark all of them at once
+        marked_emails = extract_emails(
+            mark_senders(senders_list, get_mark_predicate(args))
         )
 
-        print(f'Created filter with id: {result.get("id")}')
+        # Different sender names can share the same email address
+        unfiltered_emails = [
+            email
+            for email in dict.fromkeys(marked_emails)
+            if email not in filtered_senders
+        ]
+
+        if not unfiltered_emails:
+            print("No senders marked, no filter created.")
+
+        # One filter per chunk keeps the criteria under Gmail's length limit
+        for criteria in chunk_or(unfiltered_emails):
+            # Change filter criteria
+            # https://developers.google.com/gmail/api/reference/rest/v1/users.settings.filters#Filter
+            filter_content = {
+                "criteria": {"from": criteria},
+                "action": {
+                    "addLabelIds": ["TRASH"],
+                    "removeLabelIds": ["INBOX"],
+                },
+            }
+
+            result = (
+                service.users()
+                .settings()
+                .filters()
+                .create(userId="me", body=filter_content)
+                .execute()
+            )
+
+            print(f'Created filter with id: {result.get("id")}')
 
         # Getting project root directory
         # cwd = os.getcwd()
         # Deleting token.json file after successful execution
         # os.remove(f"{cwd}/token.json")
 
-    except HttpError as error:
+    except (HttpError, RequestsHTTPError) as error:
         print(f"An error occurred: {error}")
 
 
@@ -1,3 +1,4 @@
+import argparse
 import os.path
 import re
 
@@ -17,6 +18,12 @@ SCOPES = [
     "https://www.googleapis.com/auth/gmail.modify",
 ]
 
+# Email address within angle brackets, e.g. "Name <name@example.com>"
+EMAIL_RE = re.compile(r"<([^>]+)>")
+
+# Maximum number of messages Gmail returns from a single list request
+PAGE_SIZE = 500
+
 
 def get_messages_id_list(service: Resource, messages_list: list) -> list[str]:
     """Extracts a list of message IDs from a provided list of messages.
@@ -28,12 +35,7 @@ def get_messages_id_list(service: Resource, messages_list: list) -> list[str]:
     Returns:
         A list of message IDs corresponding to the provided messages.
     """
-    messages_id = []
-
-    for message in messages_list:
-        messages_id.append(message["id"])
-
-    return messages_id
+    return [message["id"] for message in messages_list]
 
 
 def trash_msgs_except_star_label(service: Resource, message_ids: list[str]) -> None:
@@ -44,8 +46,14 @@ def trash_msgs_except_star_label(service: Resource, message_ids: list[str]) -> N
         message_ids: A list of message IDs to send to trash.
     """
     for message_id in message_ids:
-        message = service.users().messages().get(userId="me", id=message_id).execute()
-        if "STARRED" not in message["labelIds"]:
+        # Only labelIds are needed, "minimal" skips headers and body entirely
+        message = (
+            service.users()
+            .messages()
+            .get(userId="me", id=message_id, format="minimal", fields="labelIds")
+            .execute()
+        )
+        if "STARRED" not in message.get("labelIds", []):
             service.users().messages().trash(userId="me", id=message_id).execute()
             print(f"Message {message_id} send to trash successfully.")
         else:
@@ -62,16 +70,53 @@ def extract_emails(senders: set[str]) -> list[str]:
     Returns:
         A list containing the extracted email addresses.
     """
-    emails = []
-    for text in senders:
-        email_match = re.search(r"<(.*?)>", text)  # Extract email within angle brackets
-        if email_match:
-            email = email_match.group(1)
-            emails.append(email)
-    return emails
+    return [
+        email_match.group(1)
+        for email_match in map(EMAIL_RE.search, senders)
+        if email_match
+    ]
+
+
+def save_credentials(creds: Credentials, path: str = "token.json") -> None:
+    """
+    Saves the credentials for the next run without leaving a truncated token file.
+
+    Args:
+        creds: The credentials to save.
+        path: The path of the token file.
+    """
+    # Write a temporary file first, so an interrupted write keeps the old token
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "w") as token:
+            token.write(creds.to_json())
+        os.replace(tmp_path, path)
+    finally:
+        # Only left behind if the write or the rename failed
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def parse_args() -> argparse.Namespace:
+    """
+    Parses the command line options.
+
+    Returns:
+        The parsed command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Send messages to trash, except those with the STARRED label."
+    )
+    parser.add_argument(
+        "--all-pages",
+        action="store_true",
+        help="go through every page of messages instead of only the first one",
+    )
+    return parser.parse_args()
 
 
 def main():
+    args = parse_args()
     creds = None
     # The file token.json stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
@@ -86,33 +131,37 @@ def main():
             flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
             creds = flow.run_local_server(port=0)
         # Save the credentials for the next run
-        with open("token.json", "w") as token:
-            token.write(creds.to_json())
+        save_credentials(creds)
 
     try:
-        # Create gmail api client
-        service = build("gmail", "v1", credentials=creds)
+        # Create gmail api client from the discovery document bundled with the library
+        service = build("gmail", "v1", credentials=creds, static_discovery=True)
         page_token = None
 
-        messages = (
-            service.users()
-            .messages()
-            .list(userId="me", maxResults=250, pageToken=page_token)
-            .execute()
-            .get("messages")
-        )
-
         while True:
+            response = (
+                service.users()
+                .messages()
+                .list(
+                    userId="me",
+                    maxResults=PAGE_SIZE,
+                    pageToken=page_token,
+                    fields="messages/id,nextPageToken",
+                )
+                .execute()
+            )
+
             trash_msgs_except_star_label(
-                service, get_messages_id_list(service, messages)
+                service, get_messages_id_list(service, response.get("messages", []))
             )
 
             # Check for the presence of a next page token
-            # lastest message on a page contains information does next page exists
-            # if page_token does not exist, sets token to 'None'
-            page_token = messages[-1].get("nextPageToken", None)
+            # the token is returned alongside the messages on the list response
+            # if it does not exist this is the last page
+            page_token = response.get("nextPageToken")
 
-            if not page_token:
+            # Trashing the whole mailbox has to be asked for explicitly
+            if not page_token or not args.all_pages:
                 break
 
         # Getting project root directory
@@ -12,56 +12,119 @@ from googleapiclient.errors import HttpError
 # https://developers.google.cn/gmail/api/auth/scopes?hl=en#:~:text=Gmail%20API%20scopes%20To%20define%20the%20level%20of,data%20it%20accesses%2C%20and%20the%20level%20of%20access.
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 
+# Maximum number of calls Gmail accepts in a single batch request
+# https://developers.google.com/gmail/api/guides/batch
+BATCH_SIZE = 100
 
-def get_message_details(service: Resource, message_id: str) -> dict[str, str]:
+# Number of times a failed call is retried, with an exponential backoff,
+# when Gmail rate limits it or fails temporarily
+MAX_RETRIES = 5
+
+
+def parse_message_details(message: dict) -> dict[str, str]:
     """
-    This function retrieves the details of a specific email message from a Gmail inbox.
+    This function reads the sender and subject from a message's headers.
 
     Args:
-        service: An authorized Gmail API service object.
-        message_id: The ID of the message to retrieve details for.
+        message: A message resource returned by the Gmail API.
 
     Returns:
         A dictionary containing the sender email address and subject of the message.
     """
-    message = (
-        service.users()
-        .messages()
-        .get(userId="me", id=message_id, format="full")
-        .execute()
-    )
-    headers = message["payload"]["headers"]
-    sender = [header["value"] for header in headers if header["name"] == "From"][0]
-    subject = [header["value"] for header in headers if header["name"] == "Subject"][0]
-    return {"sender": sender, "subject": subject}
-
-
-def get_unique_senders(service: Resource, messages_list: list) -> set[str]:
+    headers = {
+        header["name"]: header["value"]
+        for header in message.get("payload", {}).get("headers", [])
+    }
+    return {"sender": headers.get("From", ""), "subject": headers.get("Subject", "")}
+
+
+def get_messages_details(
+    service: Resource, messages_list: list
+) -> list[dict[str, str]]:
     """
-    This function finds all unique sender email addresses from a list of message IDs.
+    This function retrieves the sender and subject of every message in a single pass.
 
     Args:
         service: An authorized Gmail API service object.
         messages_list: A list of dictionaries containing message IDs (e.g., from a Gmail API response).
 
     Returns:
-        A set containing all unique sender email addresses found in the messages.
+        A list of dictionaries containing the sender email address and subject of each message.
     """
-    unique_senders = set()
+    messages_details = {}
+    failed_ids = []
 
-    for mess in messages_list:
-        message_data = (
+    def get_message(message_id):
+        return (
             service.users()
             .messages()
-            .get(userId="me", id=mess["id"], format="full")
-            .execute()
+            .get(
+                userId="me",
+                id=message_id,
+                format="metadata",
+                metadataHeaders=["From", "Subject"],
+                fields="payload/headers",
+            )
         )
-        for header in message_data["payload"]["headers"]:
-            if header["name"] == "From":
-                if header["value"] not in unique_senders:
-                    unique_senders.add(header["value"])
 
-    return unique_senders
+    def collect_details(request_id, response, exception):
+        # Keep going, so one failed call doesn't discard the rest of the batch
+        if exception is not None:
+            failed_ids.append(request_id)
+            return
+        messages_details[request_id] = parse_message_details(response)
+
+    for start in range(0, len(messages_list), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=collect_details)
+        batch_ids = [mess["id"] for mess in messages_list[start : start + BATCH_SIZE]]
+        for message_id in batch_ids:
+            batch.add(get_message(message_id), request_id=message_id)
+        try:
+            batch.execute()
+        except HttpError:
+            # The whole batch request failed, none of its calls were answered
+            failed_ids.extend(
+                message_id
+                for message_id in batch_ids
+                if message_id not in messages_details
+            )
+
+    # Retry the failed calls one by one, backing off when rate limited
+    for message_id in failed_ids:
+        try:
+            message = get_message(message_id).execute(num_retries=MAX_RETRIES)
+        except HttpError as error:
+            # The message was deleted since it was listed
+            if error.resp.status == 404:
+                continue
+            raise
+        messages_details[message_id] = parse_message_details(message)
+
+    return [
+        messages_details[mess["id"]]
+        for mess in messages_list
+        if mess["id"] in messages_details
+    ]
+
+
+def save_credentials(creds: Credentials, path: str = "token.json") -> None:
+    """
+    Saves the credentials for the next run without leaving a truncated token file.
+
+    Args:
+        creds: The credentials to save.
+        path: The path of the token file.
+    """
+    # Write a temporary file first, so an interrupted write keeps the old token
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "w") as token:
+            token.write(creds.to_json())
+        os.replace(tmp_path, path)
+    finally:
+        # Only left behind if the write or the rename failed
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 def main():
@@ -79,27 +142,30 @@ def main():
             flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
             creds = flow.run_local_server(port=0)
         # Save the credentials for the next run
-        with open("token.json", "w") as token:
-            token.write(creds.to_json())
+        save_credentials(creds)
 
     try:
-        # Create gmail api client
-        service = build("gmail", "v1", credentials=creds)
+        # Create gmail api client from the discovery document bundled with the library
+        service = build("gmail", "v1", credentials=creds, static_discovery=True)
 
         messages = (
-            service.users().messages().list(userId="me").execute().get("messages")
+            service.users()
+            .messages()
+            .list(userId="me", fields="messages/id")
+            .execute()
+            .get("messages", [])
         )
-        messages_list = []
 
-        # Getting sender and subject of the message
-        for mess in messages:
-            message_id = mess["id"]
-            message_details = get_message_details(service, message_id)
-            messages_list.append(message_details)
+        # Getting sender and subject of the message, each message is fetched once
+        messages_list = get_messages_details(service, messages)
+        for message_details in messages_list:
             print(message_details)
 
         print("-------------------------------------------------------")
-        print("Unique senders:", get_unique_senders(service, messages))
+        print(
+            "Unique senders:",
+            {message_details["sender"] for message_details in messages_list},
+        )
 
         # Getting project root directory
         cwd = os.getcwd()